@@ -0,0 +1,248 @@
+"""Local TCP proxy for injecting network faults in front of cluster nodes
+
+Each node gets its own listener on localhost which forwards to the node's
+S3 port. Faults are changed at runtime and apply to new and open
+connections alike:
+
+    latency    - seconds added before each response
+    jitter     - random +/- seconds added to latency
+    bandwidth  - bytes per second shared by all connections to the node
+    reset      - probability that a request is answered with a TCP reset
+    blackhole  - accept connections but silently drop all traffic
+"""
+import random
+import socket
+import struct
+from threading import Lock, Thread
+from time import sleep, time
+
+CHUNK_SIZE = 64 * 1024
+
+
+class Faults(object):
+
+    def __init__(self, latency=0, jitter=0, bandwidth=None, reset=0, blackhole=False):
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.reset = reset
+        self.blackhole = blackhole
+
+    def delay(self):
+        if not (self.latency or self.jitter):
+            return 0
+        return max(self.latency + random.uniform(-self.jitter, self.jitter), 0)
+
+    def __nonzero__(self):
+        return bool(self.latency or self.jitter or self.bandwidth or
+                    self.reset or self.blackhole)
+
+    def __str__(self):
+        if not self:
+            return "none"
+        parts = []
+        if self.latency:
+            parts.append("latency={:.0f}ms".format(self.latency * 1000))
+        if self.jitter:
+            parts.append("jitter={:.0f}ms".format(self.jitter * 1000))
+        if self.bandwidth:
+            parts.append("bandwidth={}B/s".format(self.bandwidth))
+        if self.reset:
+            parts.append("reset={}".format(self.reset))
+        if self.blackhole:
+            parts.append("blackhole")
+        return " ".join(parts)
+
+
+class NodeProxy(object):
+    """Forward connections from a localhost port to a single node"""
+
+    def __init__(self, name, target, listen_host='127.0.0.1', listen_port=0):
+        self.name = name
+        self.target = target
+        self.faults = Faults()
+        self.throttle = Throttle()
+        self.connections = set()
+        self.lock = Lock()
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((listen_host, listen_port))
+        self.server.listen(64)
+        self.address = self.server.getsockname()
+        self.running = True
+        thread = Thread(target=self._accept_loop, name='proxy-' + name)
+        thread.daemon = True
+        thread.start()
+
+    @property
+    def url(self):
+        return "http://{}:{}".format(*self.address)
+
+    def stop(self):
+        self.running = False
+        close_quietly(self.server)
+        with self.lock:
+            connections = list(self.connections)
+        for conn in connections:
+            conn.close()
+
+    def _accept_loop(self):
+        while self.running:
+            try:
+                client, _ = self.server.accept()
+            except socket.error:
+                break
+            thread = Thread(target=self._open, args=(client,))
+            thread.daemon = True
+            thread.start()
+
+    def _open(self, client):
+        if self.faults.blackhole:
+            upstream = None
+        else:
+            try:
+                upstream = socket.create_connection(self.target, timeout=5)
+                upstream.settimeout(None)
+            except socket.error:
+                close_quietly(client)
+                return
+        conn = Connection(self, client, upstream)
+        with self.lock:
+            self.connections.add(conn)
+        conn.start()
+
+    def _closed(self, conn):
+        with self.lock:
+            self.connections.discard(conn)
+
+
+class Connection(object):
+
+    def __init__(self, proxy, client, upstream):
+        self.proxy = proxy
+        self.client = client
+        self.upstream = upstream
+        self.awaiting_response = False
+        self.closed = False
+
+    def start(self):
+        if self.upstream is None:
+            # blackholed on connect: swallow whatever the client sends
+            self._pipe(self.client, None, self._request_chunk)
+            return
+        thread = Thread(target=self._pipe,
+                        args=(self.upstream, self.client, self._response_chunk))
+        thread.daemon = True
+        thread.start()
+        self._pipe(self.client, self.upstream, self._request_chunk)
+
+    def _request_chunk(self, data):
+        faults = self.proxy.faults
+        if not self.awaiting_response:
+            self.awaiting_response = True
+            if faults.reset and random.random() < faults.reset:
+                self.reset()
+                return False
+        return True
+
+    def _response_chunk(self, data):
+        if is_interim_response(data):
+            # e.g. "100 Continue" to "Expect: 100-continue": the request
+            # body and final response are still to come
+            return True
+        if self.awaiting_response:
+            self.awaiting_response = False
+            delay = self.proxy.faults.delay()
+            if delay:
+                sleep(delay)
+        return True
+
+    def _pipe(self, source, dest, on_chunk):
+        try:
+            while not self.closed:
+                data = source.recv(CHUNK_SIZE)
+                if not data:
+                    break
+                faults = self.proxy.faults
+                if faults.blackhole or dest is None:
+                    continue
+                if not on_chunk(data):
+                    break
+                if faults.bandwidth:
+                    self.proxy.throttle.consume(len(data), faults.bandwidth)
+                dest.sendall(data)
+        except socket.error:
+            pass
+        finally:
+            self.close()
+
+    def reset(self):
+        """Close the client socket with RST instead of FIN"""
+        try:
+            self.client.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                                   struct.pack('ii', 1, 0))
+            self.client.close()
+        except socket.error:
+            pass
+        self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        for sock in (self.client, self.upstream):
+            if sock is not None:
+                close_quietly(sock)
+        self.proxy._closed(self)
+
+
+class Throttle(object):
+    """Shared bandwidth cap: callers sleep until their bytes fit the rate"""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.next_free = 0
+
+    def consume(self, num_bytes, rate):
+        with self.lock:
+            now = time()
+            start = max(now, self.next_free)
+            self.next_free = start + float(num_bytes) / rate
+            delay = self.next_free - now
+        sleep(delay)
+
+
+class FaultProxy(object):
+    """A collection of node proxies keyed by node name"""
+
+    def __init__(self):
+        self.nodes = {}
+
+    def add_node(self, name, target):
+        if name not in self.nodes:
+            self.nodes[name] = NodeProxy(name, target)
+        return self.nodes[name]
+
+    def endpoints(self):
+        return {name: proxy.url for name, proxy in self.nodes.items()}
+
+    def set_faults(self, name, faults):
+        self.nodes[name].faults = faults
+
+    def stop(self):
+        for proxy in self.nodes.values():
+            proxy.stop()
+        self.nodes = {}
+
+
+def is_interim_response(data):
+    """Check if data starts with an informational (1xx) HTTP status line"""
+    return data.startswith("HTTP/1.") and data[9:10] == "1"
+
+
+def close_quietly(sock):
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except socket.error:
+        pass
+    sock.close()
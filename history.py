@@ -0,0 +1,240 @@
+"""Store scripted runs in SQLite so they can be compared later"""
+import json
+import sqlite3
+from collections import namedtuple
+from time import localtime, strftime, time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started REAL,
+    finished REAL,
+    script TEXT,
+    label TEXT,
+    config TEXT,
+    latency_window INTEGER
+);
+CREATE TABLE IF NOT EXISTS commands (
+    run_id INTEGER,
+    seq INTEGER,
+    line TEXT,
+    duration REAL,
+    ok INTEGER,
+    requests INTEGER,
+    errors INTEGER,
+    rate REAL,
+    p50 REAL,
+    p99 REAL
+);
+CREATE TABLE IF NOT EXISTS validations (
+    run_id INTEGER,
+    seq INTEGER,
+    bucket TEXT,
+    total INTEGER,
+    success INTEGER,
+    mismatch INTEGER,
+    s3_not_found INTEGER,
+    fs_not_found INTEGER
+);
+CREATE TABLE IF NOT EXISTS latencies (
+    run_id INTEGER,
+    op TEXT,
+    count INTEGER,
+    errors INTEGER,
+    rate REAL,
+    p50 REAL,
+    p95 REAL,
+    p99 REAL,
+    max REAL,
+    throughput REAL
+);
+"""
+
+Run = namedtuple('Run', 'id started finished script label config latency_window')
+
+# commands whose duration is the time taken for the cluster to converge
+CONVERGENCE_COMMANDS = ('add_node', 'add_nodes', 'wait_for_rebalance')
+
+
+class RunHistory(object):
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(runs)")]
+        if "latency_window" not in columns:
+            with self.db:
+                self.db.execute("ALTER TABLE runs ADD COLUMN latency_window INTEGER")
+
+    def close(self):
+        self.db.close()
+
+    def start_run(self, script, label=None):
+        with self.db:
+            cursor = self.db.execute(
+                "INSERT INTO runs (started, script, label, config) VALUES (?, ?, ?, ?)",
+                (time(), script, label, "{}"))
+        return cursor.lastrowid
+
+    def finish_run(self, run_id, config, latencies, latency_window=None):
+        """Record the cluster configuration and overall latency per op
+
+        :param config: JSON serializable dict.
+        :param latencies: Sequence of ``(op, metrics.Summary)``.
+        :param latency_window: Number of most recent requests the latency
+        percentiles were computed from.
+        """
+        with self.db:
+            self.db.execute(
+                "UPDATE runs SET finished = ?, config = ?, latency_window = ? WHERE id = ?",
+                (time(), json.dumps(config, sort_keys=True), latency_window, run_id))
+            self.db.executemany(
+                "INSERT INTO latencies VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(run_id, op) + tuple(summary) for op, summary in latencies])
+
+    def record_command(self, run_id, seq, line, duration, ok, summary):
+        """Record a command with a summary of the requests it made"""
+        with self.db:
+            self.db.execute(
+                "INSERT INTO commands VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (run_id, seq, line, duration, ok, summary.count, summary.errors,
+                 summary.rate, summary.p50, summary.p99))
+
+    def record_validation(self, run_id, seq, bucket, results):
+        """Record a ``s3fsdb.ValidateResult``"""
+        with self.db:
+            self.db.execute(
+                "INSERT INTO validations VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (run_id, seq, bucket) + tuple(results))
+
+    def runs(self):
+        rows = self.db.execute("SELECT * FROM runs ORDER BY id")
+        return [Run(*row) for row in rows]
+
+    def get_run(self, run_id):
+        row = self.db.execute("SELECT * FROM runs WHERE id = ?", (run_id,)).fetchone()
+        if row is None:
+            raise KeyError(run_id)
+        return Run(*row)
+
+    def compare(self, run_a, run_b):
+        """Report how two runs differ
+
+        Commands and validations are matched by their text and occurrence
+        so scripts that differ slightly can still be compared. The duration
+        of commands that wait for the cluster to rebalance is reported as
+        convergence time.
+
+        :returns: list of report lines.
+        """
+        a, b = self.get_run(run_a), self.get_run(run_b)
+        lines = ["A: " + describe(a), "B: " + describe(b), ""]
+
+        lines.append("{:<40} {:>10} {:>10} {:>8}".format("command", "A", "B", "change"))
+        query = ("SELECT line, duration, ok, requests, errors, rate, p99 "
+                 "FROM commands WHERE run_id = ? ORDER BY seq")
+        for line, row_a, row_b in self._pair(query, run_a, run_b):
+            converges = line.split()[0] in CONVERGENCE_COMMANDS
+            metric = "converge" if converges else "time"
+            lines.append(compare_row(line, metric, row_a, row_b, 1, "{:.1f}s"))
+            if (row_a and row_a[3]) or (row_b and row_b[3]):
+                lines.append(compare_row("", "ops/s", row_a, row_b, 5, "{:.1f}"))
+                lines.append(compare_row("", "p99", row_a, row_b, 6, "{:.3f}s"))
+                lines.append(compare_row("", "errors", row_a, row_b, 4, "{}"))
+                lines.append(compare_row("", "error %", row_a, row_b,
+                                         error_rate(4, 3), "{:.2%}"))
+
+        lines.append("")
+        lines.append("{:<40} {:>10} {:>10}".format("validation", "A", "B"))
+        query = ("SELECT bucket, total, success FROM validations "
+                 "WHERE run_id = ? ORDER BY seq")
+        for bucket, row_a, row_b in self._pair(query, run_a, run_b):
+            lines.append("{:<40} {:>10} {:>10}".format(
+                bucket, format_validation(row_a), format_validation(row_b)))
+
+        lines.append("")
+        lines.append("{:<40} {:>10} {:>10} {:>8}".format("latency", "A", "B", "change"))
+        query = ("SELECT op, count, errors, rate, p50, p99, throughput "
+                 "FROM latencies WHERE run_id = ? ORDER BY op")
+        for op, row_a, row_b in self._pair(query, run_a, run_b):
+            lines.append(compare_row(op, "ops/s", row_a, row_b, 3, "{:.1f}"))
+            lines.append(compare_row("", "p50", row_a, row_b, 4, "{:.3f}s"))
+            lines.append(compare_row("", "p99", row_a, row_b, 5, "{:.3f}s"))
+            lines.append(compare_row("", "errors", row_a, row_b, 2, "{}"))
+            lines.append(compare_row("", "error %", row_a, row_b,
+                                     error_rate(2, 1), "{:.2%}"))
+
+        windows = [a.latency_window, b.latency_window]
+        if any(windows):
+            lines.append("")
+            lines.append("Percentiles cover at most the last {} requests of each "
+                         "command or run; counts, errors and rates cover all "
+                         "requests.".format(max(windows)))
+        return lines
+
+    def _pair(self, query, run_a, run_b):
+        """Pair rows of two runs on (first column, occurrence)"""
+        def keyed(run_id):
+            seen = {}
+            result = []
+            for row in self.db.execute(query, (run_id,)):
+                nth = seen[row[0]] = seen.get(row[0], 0) + 1
+                result.append(((row[0], nth), row))
+            return result
+
+        rows_a = keyed(run_a)
+        rows_b = dict(keyed(run_b))
+        keys_a = set(key for key, row in rows_a)
+        paired = [(key[0], row, rows_b.get(key)) for key, row in rows_a]
+        paired.extend((key[0], None, row) for key, row in keyed(run_b)
+                      if key not in keys_a)
+        return paired
+
+
+def describe(run):
+    config = json.loads(run.config or "{}")
+    details = ", ".join("{}={}".format(k, v) for k, v in sorted(config.items()))
+    return "run {} {} {}{} {}".format(
+        run.id,
+        strftime("%Y-%m-%d %H:%M", localtime(run.started)),
+        run.script,
+        " [{}]".format(run.label) if run.label else "",
+        details,
+    )
+
+
+def compare_row(name, metric, row_a, row_b, index, fmt):
+    """Format a metric of two rows and the change between them
+
+    :param index: Column index of the metric or a function of the row.
+    """
+    get = index if callable(index) else lambda row: row[index]
+    value_a = get(row_a) if row_a else None
+    value_b = get(row_b) if row_b else None
+    return "{:<30} {:>9} {:>10} {:>10} {:>8}".format(
+        name[:30], metric,
+        "-" if value_a is None else fmt.format(value_a),
+        "-" if value_b is None else fmt.format(value_b),
+        change(value_a, value_b),
+    )
+
+
+def error_rate(errors_index, count_index):
+    def get(row):
+        count = row[count_index]
+        return float(row[errors_index]) / count if count else None
+    return get
+
+
+def change(value_a, value_b):
+    if value_a is None or value_b is None or value_a == value_b:
+        return ""
+    if not value_a:
+        return "new"
+    return "{:+.1f}%".format((value_b - value_a) * 100.0 / value_a)
+
+
+def format_validation(row):
+    if row is None:
+        return "-"
+    return "{}/{}".format(row[2], row[1])
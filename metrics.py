@@ -0,0 +1,268 @@
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from collections import deque, namedtuple
+from threading import Lock, Thread
+from time import time
+
+Sample = namedtuple('Sample', 'timestamp op bucket node latency ok size')
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+RATE_WINDOW = 10
+TOTALS_KEY = ('op', 'bucket', 'node')
+
+
+class Summary(namedtuple('Summary', 'count errors rate p50 p95 p99 max throughput')):
+
+    def __str__(self):
+        text = ("{0.count} ops ({0.errors} errors) {0.rate:.1f} ops/s "
+                "p50={1:.0f}ms p95={2:.0f}ms p99={3:.0f}ms max={4:.0f}ms".format(
+            self, self.p50 * 1000, self.p95 * 1000, self.p99 * 1000, self.max * 1000))
+        if self.throughput:
+            text += " {:.2f}MB/s".format(self.throughput / 1024.0 ** 2)
+        return text
+
+
+class Metrics(object):
+    """Thread-safe record of recent S3 request latencies
+
+    Samples are tagged with the operation, bucket and target node so
+    summaries can be narrowed down to show how a single slow node affects
+    client throughput and tail latency. Totals are also kept per
+    (op, bucket, node) for export in Prometheus format.
+    """
+
+    def __init__(self, window=100000):
+        self.lock = Lock()
+        self.samples = deque(maxlen=window)
+        self.totals = {}
+
+    def record(self, op, bucket, node, latency, ok=True, size=0):
+        sample = Sample(time(), op, bucket, node, latency, ok, size)
+        with self.lock:
+            self.samples.append(sample)
+            key = (op, bucket, node)
+            if key not in self.totals:
+                self.totals[key] = Totals()
+            self.totals[key].add(sample)
+
+    def reset(self):
+        with self.lock:
+            self.samples.clear()
+            self.totals = {}
+
+    def select(self, since=None, **filters):
+        with self.lock:
+            samples = list(self.samples)
+        if since is not None:
+            samples = [s for s in samples if s.timestamp >= since]
+        for field, value in filters.items():
+            if value is not None:
+                samples = [s for s in samples if getattr(s, field) == value]
+        return samples
+
+    def summary(self, since=None, **filters):
+        return summarize(self.select(since, **filters), since)
+
+    def summaries(self, by, since=None, **filters):
+        """Get a summary per distinct value of the ``by`` sample field"""
+        groups = {}
+        for sample in self.select(since, **filters):
+            groups.setdefault(getattr(sample, by), []).append(sample)
+        return sorted((key, summarize(samples, since))
+                      for key, samples in groups.items())
+
+    def snapshot(self):
+        """Copy the cumulative totals for use with ``totals_summaries``"""
+        with self.lock:
+            return {key: value.copy() for key, value in self.totals.items()}
+
+    def totals_summaries(self, start, since, by=None):
+        """Get summaries of the requests made since a ``snapshot``
+
+        Count, errors, rate and throughput come from the cumulative totals
+        so they are exact however many requests were made. Percentiles
+        come from the sample window and only cover the most recent
+        requests when more than ``window`` were made.
+
+        :param start: ``snapshot()`` taken at ``since``.
+        :param by: 'op', 'bucket' or 'node' to get a summary per value, or
+        ``None`` for a single summary keyed by ``None``.
+        """
+        groups = {}
+        for key, total in self.snapshot().items():
+            before = start.get(key)
+            if before is None or before.count > total.count:
+                before = Totals()  # new or reset since the snapshot
+            group = key[TOTALS_KEY.index(by)] if by else None
+            counts = groups.setdefault(group, [0, 0, 0])
+            counts[0] += total.count - before.count
+            counts[1] += total.errors - before.errors
+            counts[2] += total.size - before.size
+        elapsed = max(time() - since, 0.001)
+        result = []
+        for group, (count, errors, size) in sorted(groups.items()):
+            if not count:
+                continue
+            window = self.summary(since, **({by: group} if by else {}))
+            result.append((group, Summary(
+                count, errors, count / elapsed,
+                window.p50, window.p95, window.p99, window.max, size / elapsed)))
+        return result
+
+    def prometheus(self, node_states=None):
+        """Render totals, recent rates and node states in Prometheus text format
+
+        :param node_states: dict of node name -> bool (up).
+        """
+        since = time() - RATE_WINDOW
+        with self.lock:
+            totals = sorted((key, value.copy()) for key, value in self.totals.items())
+            recent = [s for s in self.samples if s.timestamp >= since]
+        rates = {}
+        for sample in recent:
+            key = (sample.op, sample.bucket, sample.node)
+            rates[key] = rates.get(key, 0) + 1
+
+        lines = []
+        add = lines.append
+        def family(name, kind, help):
+            add("# HELP {} {}".format(name, help))
+            add("# TYPE {} {}".format(name, kind))
+
+        family("riak_repl_requests_total", "counter", "S3 requests made")
+        for key, value in totals:
+            add("riak_repl_requests_total{} {}".format(labels(key), value.count))
+        family("riak_repl_request_errors_total", "counter", "S3 requests that failed")
+        for key, value in totals:
+            add("riak_repl_request_errors_total{} {}".format(labels(key), value.errors))
+        family("riak_repl_request_bytes_total", "counter", "Bytes sent or received")
+        for key, value in totals:
+            add("riak_repl_request_bytes_total{} {}".format(labels(key), value.size))
+        family("riak_repl_request_rate", "gauge",
+               "S3 requests per second over the last {} seconds".format(RATE_WINDOW))
+        for key, value in totals:
+            add("riak_repl_request_rate{} {}".format(
+                labels(key), float(rates.get(key, 0)) / RATE_WINDOW))
+        family("riak_repl_request_duration_seconds", "histogram", "S3 request latency")
+        for key, value in totals:
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, value.buckets):
+                cumulative += count
+                add("riak_repl_request_duration_seconds_bucket{} {}".format(
+                    labels(key, le=repr(float(bound))), cumulative))
+            add("riak_repl_request_duration_seconds_bucket{} {}".format(
+                labels(key, le="+Inf"), value.count))
+            add("riak_repl_request_duration_seconds_sum{} {}".format(
+                labels(key), repr(value.latency)))
+            add("riak_repl_request_duration_seconds_count{} {}".format(
+                labels(key), value.count))
+        if node_states is not None:
+            family("riak_repl_node_up", "gauge", "1 if the node container is running")
+            for node, up in sorted(node_states.items()):
+                add('riak_repl_node_up{{node="{}"}} {}'.format(escape(node), int(up)))
+        return "\n".join(lines) + "\n"
+
+
+class Totals(object):
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.size = 0
+        self.latency = 0.0
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+
+    def add(self, sample):
+        self.count += 1
+        self.errors += not sample.ok
+        self.size += sample.size
+        self.latency += sample.latency
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if sample.latency <= bound:
+                self.buckets[i] += 1
+                break
+
+    def copy(self):
+        other = Totals()
+        other.__dict__.update(self.__dict__, buckets=list(self.buckets))
+        return other
+
+
+class MetricsServer(object):
+    """Serve metrics over HTTP in Prometheus text format from a thread
+
+    :param node_states: Callable returning a dict of node name -> bool (up).
+    Node states are left out of a scrape if it raises.
+    """
+
+    def __init__(self, metrics, port, node_states=None, host='127.0.0.1'):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                states = None
+                if server.node_states is not None:
+                    try:
+                        states = server.node_states()
+                    except Exception:
+                        pass  # leave out node states rather than fail the scrape
+                body = metrics.prometheus(states)
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.node_states = node_states
+        self.httpd = HTTPServer((host, port), Handler)
+        thread = Thread(target=self.httpd.serve_forever, name='metrics-server')
+        thread.daemon = True
+        thread.start()
+
+    @property
+    def url(self):
+        return "http://{}:{}/metrics".format(*self.httpd.server_address)
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def labels(key, **extra):
+    op, bucket, node = key
+    pairs = [("op", op), ("bucket", bucket), ("node", node)] + sorted(extra.items())
+    return "{" + ",".join('{}="{}"'.format(name, escape(value))
+                          for name, value in pairs) + "}"
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def summarize(samples, since=None):
+    if not samples:
+        return Summary(0, 0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0)
+    latencies = sorted(s.latency for s in samples)
+    start = since if since is not None else samples[0].timestamp
+    elapsed = max(time() - start, 0.001)
+    return Summary(
+        len(samples),
+        sum(1 for s in samples if not s.ok),
+        len(samples) / elapsed,
+        percentile(latencies, 50),
+        percentile(latencies, 95),
+        percentile(latencies, 99),
+        latencies[-1],
+        sum(s.size for s in samples) / elapsed,
+    )
+
+
+def percentile(sorted_values, pct):
+    index = int(round(pct / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[index]
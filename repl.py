@@ -6,12 +6,17 @@ import re
 import shutil
 import sys
 import traceback
-from time import sleep
+from functools import partial
+from time import sleep, time
 
 import sh
 
-from s3fsdb import NotFound
-from utils import wait_for_cluster_to_balance, get_db, get_ring_details
+from faultproxy import FaultProxy, Faults
+from history import RunHistory, describe as describe_run
+from metrics import MetricsServer, summarize
+from s3fsdb import NotFound, make_ranges
+from utils import (wait_for_cluster_to_balance, get_db, get_ring_details,
+    get_node_addresses, get_node_states, get_connected_db)
 
 docker = sh.Command('docker')
 
@@ -25,6 +30,8 @@ class RiakTester(cmd.Cmd):
     def __init__(self, config, stdin=None):
         cmd.Cmd.__init__(self, stdin=stdin)
         self.config = config
+        self.proxy = None
+        self.metrics_server = None
 
     def onecmd(*args, **kw):
         try:
@@ -178,28 +185,33 @@ class RiakTester(cmd.Cmd):
             self.do_help('put_blob')
             return
 
-        if not re.match(r"\d+[KMG]?$", size):
+        num_bytes = parse_size(size)
+        if num_bytes is None:
             print "invalid size: {}".format(size)
             return
-        if not size.endswith(("K", "M", "G")):
-            num_bytes = size
-        else:
-            multiplier = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}[size[-1]]
-            num_bytes = int(size[:-1]) * multiplier
 
         db = get_db(self.config)
         key = db.random_file(bucket, num_bytes, key)
         print "put {} ({} = {} bytes)".format(key, size, num_bytes)
 
     def do_get(self, args):
-        """get [bucket] [key]"""
+        """get [bucket] [key] [range=SIZE [count=N] [order=random|sequential]]
+
+        With range, read N ranges of SIZE bytes (see put_blob) and verify
+        each against the local file instead of printing the object.
+        order is random (default) or sequential.
+        """
+        options = parse_range_options(args, order='random', count=1)
         try:
-            bucket, key = args.split(' ')
+            (bucket, key), range_size, order, count = options
         except:
             self.do_help('get')
             return
 
         db = get_db(self.config)
+        if range_size:
+            self.get_ranges(db, bucket, key, range_size, order, count)
+            return
         try:
             data = db.get(key, bucket)
         except NotFound:
@@ -209,6 +221,24 @@ class RiakTester(cmd.Cmd):
             print data
             print '-' * 100
 
+    def get_ranges(self, db, bucket, key, range_size, order, count):
+        try:
+            size = db.file_size(key, bucket)
+        except OSError:
+            print '{}/{} not found locally'.format(bucket, key)
+            return
+        ranges = make_ranges(size, range_size, count, order)
+        start = time()
+        try:
+            for read in db.read_ranges(key, bucket, ranges):
+                print "  bytes {}-{}: {} {:.0f}ms".format(
+                    read.start, read.start + read.length - 1,
+                    "ok" if read.match else "MISMATCH", read.latency * 1000)
+        except NotFound:
+            print '{}/{} not found'.format(bucket, key)
+            return
+        print "  ", db.metrics.summary(since=start, op='get_range', bucket=bucket)
+
     def do_list_bucket_keys(self, bucket_name):
         """list_bucket_keys [bucket]"""
         db = get_db(self.config)
@@ -230,26 +260,35 @@ class RiakTester(cmd.Cmd):
             for bucket in buckets:
                 print bucket
 
-    def do_validate_data(self, buckets):
-        """validate_data [bucket]
+    def do_validate_data(self, args):
+        """validate_data [bucket [bucket ...]] [range=SIZE [order=random|sequential]]
         Read all the data in a bucket and check that it matches what we
-        have stored on disk"""
-        if not buckets:
+        have stored on disk. With range, read each object in ranges of
+        SIZE bytes (see put_blob) in sequential (default) or random order."""
+        options = parse_range_options(args, order='sequential')
+        if options is None or not options[0]:
             self.do_help('validate_data')
             return
 
-        buckets = buckets.split(' ')
+        buckets, range_size, order, _ = options
+        op = 'get_range' if range_size else 'get'
         db = get_db(self.config)
         for bucket in buckets:
             print '  Validating bucket', bucket
+            start = time()
             try:
-                results = db.validate(bucket)
+                results = db.validate(bucket, range_size, order)
             except Exception as e:
                 print e
             else:
                 print
                 if results.success != results.total:
                     print "  Validating error: ", results
+                self.validated(bucket, results)
+            print "  ", db.metrics.summary(since=start, op=op, bucket=bucket)
+
+    def validated(self, bucket, results):
+        """Called with the ``ValidateResult`` of each validated bucket"""
 
     def do_validate_data_continuous(self, buckets):
         """validate_data_continuous [buckets]"""
@@ -261,24 +300,30 @@ class RiakTester(cmd.Cmd):
             print
             return
 
-    def do_read_write_continuous(self, bucket):
-        """read_write_continuous [bucket]"""
+    def do_read_write_continuous(self, args):
+        """read_write_continuous [bucket] [range=SIZE [order=random|sequential]]
+        With range, reads are verified ranges of SIZE bytes (see put_blob)
+        at random (default) or sequential offsets."""
         print 'Press Ctrl-C to stop'
-        if not bucket:
+        options = parse_range_options(args, order='random')
+        if options is None or len(options[0]) != 1:
             self.do_help('read_write_continuous')
             return
 
+        (bucket,), range_size, order, _ = options
         db = get_db(self.config)
+        read = partial(db.random_read, range_size=range_size, order=order)
         actions = {
-            'read1': db.random_read,
-            'read2': db.random_read,
-            'read3': db.random_read,
-            'read4': db.random_read,
+            'read1': read,
+            'read2': read,
+            'read3': read,
+            'read4': read,
             'write': db.create_file,
         }
 
         count = 0
         fails = []
+        since = time()
         try:
             while True:
                 count += 1
@@ -290,14 +335,162 @@ class RiakTester(cmd.Cmd):
 
                 if count % 100 == 0:
                     print
-                    print count
+                    print count, db.metrics.summary(since=since, bucket=bucket)
+                    if db.endpoints:
+                        self.print_summaries('node', since=since, bucket=bucket)
                     for fail in fails:
                         print '    ', fail
                     fails = []
+                    since = time()
         except KeyboardInterrupt:
             print
             return
 
+    def do_stats(self, bucket):
+        """stats [bucket]
+        Show request latency and throughput per operation and node"""
+        self.print_summaries('op', bucket=bucket or None)
+        self.print_summaries('node', bucket=bucket or None)
+
+    def do_reset_stats(self, args):
+        """reset_stats
+        Forget all recorded request latencies"""
+        get_db(self.config).metrics.reset()
+
+    def print_summaries(self, by, **filters):
+        db = get_db(self.config)
+        for key, summary in db.metrics.summaries(by, **filters):
+            print "    {} {}: {}".format(by, key, summary)
+
+    def do_proxy_start(self, args):
+        """proxy_start
+        Send all requests through a local fault injection proxy with one
+        listener per running node. Run again after adding nodes."""
+        if self.proxy is None:
+            self.proxy = FaultProxy()
+        for node, address in sorted(get_node_addresses(self.config).items()):
+            self.proxy.add_node(node, address)
+        get_db(self.config).set_endpoints(self.proxy.endpoints())
+        self.do_list_faults('')
+
+    def do_proxy_stop(self, args):
+        """proxy_stop
+        Stop the fault injection proxy and send requests directly to the
+        cluster again"""
+        get_db(self.config).set_endpoints({})
+        if self.proxy is not None:
+            self.proxy.stop()
+            self.proxy = None
+
+    def do_fault(self, args):
+        """fault [node index] [fault [fault ...]]
+        Inject network faults between the REPL and a node. Requires
+        proxy_start. Faults replace any previously set on the node:
+
+            latency=MS      delay each response
+            jitter=MS       random +/- delay added to latency
+            bandwidth=N     cap node bandwidth at N[KMG] bytes per second
+            reset=P         reset connections on a fraction P of requests
+            blackhole       silently drop all traffic
+            clear           remove all faults
+
+        Example: fault 02 latency=200 jitter=50 reset=0.05
+        """
+        argv = args.split()
+        if len(argv) < 2:
+            self.do_help('fault')
+            return
+        if self.proxy is None or argv[0] not in self.proxy.nodes:
+            print "node {} is not proxied (run proxy_start)".format(argv[0])
+            return
+
+        faults = Faults()
+        for arg in argv[1:]:
+            name, _, value = arg.partition('=')
+            try:
+                if name in ('latency', 'jitter'):
+                    if int(value) < 0:
+                        raise ValueError(value)
+                    setattr(faults, name, int(value) / 1000.0)
+                elif name == 'bandwidth':
+                    faults.bandwidth = parse_size(value)
+                    if not faults.bandwidth:
+                        raise ValueError(value)
+                elif name == 'reset':
+                    faults.reset = float(value)
+                    if not 0 <= faults.reset <= 1:
+                        raise ValueError(value)
+                elif name == 'blackhole' and not value:
+                    faults.blackhole = True
+                elif name != 'clear' or value:
+                    raise ValueError(arg)
+            except ValueError:
+                print "invalid fault: {}".format(arg)
+                return
+        self.proxy.set_faults(argv[0], faults)
+        self.do_list_faults('')
+
+    def do_list_faults(self, args):
+        """list_faults
+        List the proxied nodes and their faults"""
+        if self.proxy is None:
+            print "proxy not running"
+            return
+        for node, proxy in sorted(self.proxy.nodes.items()):
+            print "  {} {} -> {}:{} faults: {}".format(
+                node, proxy.url, proxy.target[0], proxy.target[1], proxy.faults)
+
+    def do_serve_metrics(self, port):
+        """serve_metrics [port]
+        Serve request counters, rates, latency histograms and node up/down
+        state in Prometheus text format on localhost (default port 9187)
+        while other commands run"""
+        try:
+            port = int(port or 9187)
+        except ValueError:
+            self.do_help('serve_metrics')
+            return
+        self.do_stop_metrics('')
+        db = get_db(self.config)
+        self.metrics_server = MetricsServer(db.metrics, port, get_node_states)
+        print "serving metrics at", self.metrics_server.url
+
+    def do_stop_metrics(self, args):
+        """stop_metrics
+        Stop serving metrics"""
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+            self.metrics_server = None
+
+    def do_list_runs(self, args):
+        """list_runs
+        List the scripted runs recorded in the run history"""
+        history = RunHistory(self.config.history_path)
+        try:
+            for run in history.runs():
+                print " ", describe_run(run)
+        finally:
+            history.close()
+
+    def do_compare_runs(self, args):
+        """compare_runs [run id] [run id]
+        Compare command durations, request rates, validation results and
+        latencies of two scripted runs (see list_runs)"""
+        try:
+            run_a, run_b = [int(arg) for arg in args.split()]
+        except ValueError:
+            self.do_help('compare_runs')
+            return
+
+        history = RunHistory(self.config.history_path)
+        try:
+            for line in history.compare(run_a, run_b):
+                print line
+        except KeyError as e:
+            print "run {} not found".format(e)
+        finally:
+            history.close()
+
     def do_wait(self, args):
         """wait [N seconds]"""
         for i in range(int(args)):
@@ -307,6 +500,51 @@ class RiakTester(cmd.Cmd):
         print
 
 
+def parse_size(size):
+    """Parse a number of bytes followed by an optional K, M or G multiplier
+
+    :returns: Number of bytes or ``None`` if size is invalid.
+    """
+    if not re.match(r"\d+[KMG]?$", size):
+        return None
+    if not size.endswith(("K", "M", "G")):
+        return int(size)
+    multiplier = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}[size[-1]]
+    return int(size[:-1]) * multiplier
+
+
+def parse_range_options(args, order, count=None):
+    """Parse ``range=SIZE``, ``order=...`` and ``count=N`` options
+
+    :param count: Default count. ``None`` if the command does not accept
+    ``count``, which is only valid together with ``range``.
+    :returns: ``(positional args, range size, order, count)`` or ``None``
+    if an option is invalid.
+    """
+    argv = []
+    range_size = None
+    count_given = False
+    for arg in args.split():
+        name, sep, value = arg.partition('=')
+        if not sep:
+            argv.append(arg)
+        elif name == 'range':
+            range_size = parse_size(value)
+            if not range_size:
+                return None
+        elif name == 'order' and value in ('random', 'sequential'):
+            order = value
+        elif (name == 'count' and count is not None
+                and value.isdigit() and int(value)):
+            count = int(value)
+            count_given = True
+        else:
+            return None
+    if count_given and not range_size:
+        return None
+    return argv, range_size, order, count
+
+
 class AutoRiakTester(RiakTester):
     # Disable rawinput module use
     use_rawinput = False
@@ -314,7 +552,77 @@ class AutoRiakTester(RiakTester):
     # Do not show a prompt after each command read
     prompt = ''
 
+    def __init__(self, config, stdin=None, history=None, label=None):
+        """
+        :param history: Optional ``RunHistory`` in which to record the run.
+        :param label: Optional label of the run in the history.
+        """
+        RiakTester.__init__(self, config, stdin=stdin)
+        self.history = history
+        self.seq = 0
+        self.started = time()
+        self.start_totals = {}
+        if history is not None:
+            metrics = self.get_metrics()
+            if metrics:
+                self.start_totals = metrics.snapshot()
+            script = getattr(stdin, 'name', None)
+            self.run_id = history.start_run(script, label)
+            print "Recording run", self.run_id
+
     def precmd(self, line):
         if line and line[0] != '#':
             print line
         return cmd.Cmd.precmd(self, line)
+
+    def onecmd(self, line):
+        if (self.history is None or not line.strip() or line.startswith('#')
+                or line == 'EOF'):
+            return RiakTester.onecmd(self, line)
+
+        self.seq += 1
+        metrics = self.get_metrics()
+        totals = metrics.snapshot() if metrics else {}
+        start = time()
+        ok = False
+        try:
+            stop = cmd.Cmd.onecmd(self, line)
+            ok = True
+            return stop
+        except Exception:
+            traceback.print_exc()
+        finally:
+            metrics = self.get_metrics()
+            summaries = metrics.totals_summaries(totals, start) if metrics else []
+            summary = dict(summaries).get(None, summarize([]))
+            self.history.record_command(
+                self.run_id, self.seq, line.strip(), time() - start, ok, summary)
+
+    def validated(self, bucket, results):
+        if self.history is not None:
+            self.history.record_validation(self.run_id, self.seq, bucket, results)
+
+    def postloop(self):
+        if self.history is None:
+            return
+        config = {}
+        try:
+            config["nodes"] = sum(get_node_states().values())
+            config["ring_partitions"] = get_ring_details()[0]
+        except Exception:
+            pass
+        metrics = self.get_metrics()
+        latencies = []
+        window = None
+        if metrics:
+            window = metrics.samples.maxlen
+            latencies = metrics.totals_summaries(
+                self.start_totals, self.started, by='op')
+        self.history.finish_run(self.run_id, config, latencies, window)
+        print "Recorded run", self.run_id
+
+    def get_metrics(self):
+        # don't connect here: the cluster (and config) may not exist yet or
+        # may be replaced by a command such as reset followed by add_nodes
+        db = get_connected_db()
+        return db.metrics if db is not None else None
@@ -3,18 +3,22 @@ from __future__ import print_function
 import sys
 from collections import namedtuple
 
+from history import RunHistory
 from repl import RiakTester, AutoRiakTester
 
 Command = namedtuple('Command', 'name args')
-Config = namedtuple('Config', 'data_dir default_bucket riak_config_path')
-CONFIG = Config('test_data', 'default', 'config.json')
+Config = namedtuple('Config', 'data_dir default_bucket riak_config_path history_path')
+CONFIG = Config('test_data', 'default', 'config.json', 'history.sqlite')
 
 if __name__ == '__main__':
     if len(sys.argv) > 1:
+        label = sys.argv[2] if len(sys.argv) > 2 else None
         input = open(sys.argv[1], 'rt')
+        history = RunHistory(CONFIG.history_path)
         try:
-            AutoRiakTester(CONFIG, stdin=input).cmdloop()
+            AutoRiakTester(CONFIG, stdin=input, history=history, label=label).cmdloop()
         finally:
+            history.close()
             input.close()
     else:
         RiakTester(CONFIG).cmdloop()
@@ -1,3 +1,4 @@
+import mmap
 import os
 import random
 import sys
@@ -5,6 +6,7 @@ from collections import namedtuple
 from contextlib import contextmanager
 from cStringIO import StringIO
 from threading import Lock
+from time import time
 from uuid import uuid4
 
 import boto3
@@ -14,39 +16,137 @@ from botocore.exceptions import ClientError
 from botocore.handlers import calculate_md5
 from botocore.utils import fix_s3_host
 
+from metrics import Metrics
+
 ValidateResult = namedtuple('ValidateResult',
     'total success mismatch s3_not_found fs_not_found')
+RangeRead = namedtuple('RangeRead', 'start length match latency')
 
 
 class NotFound(Exception):
     pass
 
 
+class RangeMismatch(Exception):
+    pass
+
+
 class S3FSDB(object):
 
     def __init__(self, data_dir, url, admin_key, admin_secret):
         self.data_dir = data_dir
-        self.db = boto3.resource(
+        self.url = url
+        self.admin_key = admin_key
+        self.admin_secret = admin_secret
+        self.db = self.connect(url)
+        self.endpoints = {}
+        self.buckets = {}
+        self.metrics = Metrics()
+        self.range_cursors = {}
+
+    def connect(self, url):
+        db = boto3.resource(
             's3',
             endpoint_url=url,
-            aws_access_key_id=admin_key,
-            aws_secret_access_key=admin_secret,
+            aws_access_key_id=self.admin_key,
+            aws_secret_access_key=self.admin_secret,
             config=Config(connect_timeout=2, read_timeout=5)
         )
         # https://github.com/boto/boto3/issues/259
-        self.db.meta.client.meta.events.unregister('before-sign.s3', fix_s3_host)
-        self.buckets = {}
+        db.meta.client.meta.events.unregister('before-sign.s3', fix_s3_host)
+        return db
+
+    def set_endpoints(self, urls):
+        """Spread requests over the given endpoints
+
+        :param urls: dict of node name -> url. Each request is sent to a
+        random endpoint. An empty dict sends all requests to the default url.
+        """
+        self.endpoints = {node: self.connect(url) for node, url in urls.items()}
+
+    @contextmanager
+    def request(self, op, bucket_name):
+        """Time an S3 request against a random endpoint
+
+        Yields a ``Request`` with the boto3 resource to use. Set its
+        ``size`` to the number of bytes transferred.
+        """
+        if self.endpoints:
+            node, db = random.choice(self.endpoints.items())
+        else:
+            node, db = "default", self.db
+        req = Request(db)
+        start = time()
+        ok = False
+        try:
+            yield req
+            ok = True
+        except NotFound:
+            ok = True
+            raise
+        finally:
+            self.metrics.record(op, bucket_name, node, time() - start, ok, req.size)
 
     def put(self, content, identifier, bucket_name):
         osutil = OpenFileOSUtils()
-        transfer = S3Transfer(self.db.meta.client, osutil=osutil)
-        transfer.upload_file(content, bucket_name, identifier)
+        with self.request('put', bucket_name) as req:
+            req.size = osutil.get_file_size(content)
+            transfer = S3Transfer(req.db.meta.client, osutil=osutil)
+            transfer.upload_file(content, bucket_name, identifier)
 
     def get(self, identifier, bucket_name):
-        with maybe_not_found(throw=NotFound(identifier, bucket_name)):
-            resp = self.get_bucket(bucket_name).Object(identifier).get()
-        with ClosingContextProxy(resp["Body"]) as stream:
-            return stream.read()
+        return self._get(identifier, bucket_name, 'get')
+
+    def get_range(self, identifier, bucket_name, start, length):
+        """Get ``length`` bytes of an object starting at ``start``"""
+        byte_range = "bytes={}-{}".format(start, start + length - 1)
+        return self._get(identifier, bucket_name, 'get_range', Range=byte_range)
+
+    def _get(self, identifier, bucket_name, op, **kw):
+        self.get_bucket(bucket_name)
+        with self.request(op, bucket_name) as req:
+            with maybe_not_found(throw=NotFound(identifier, bucket_name)):
+                resp = req.db.Object(bucket_name, identifier).get(**kw)
+            with ClosingContextProxy(resp["Body"]) as stream:
+                data = stream.read()
+            req.size = len(data)
+            return data
+
+    def read_ranges(self, identifier, bucket_name, ranges):
+        """Get byte ranges of an object and verify them against the local file
+
+        The local file is memory-mapped and compared without copying.
+
+        :param ranges: Sequence of ``(start, length)`` tuples.
+        :returns: Generator of ``RangeRead``. A range past the end of the
+        object (``InvalidRange``) is a mismatch.
+        :raises IOError: if the local file does not exist.
+        :raises NotFound: if the object does not exist.
+        """
+        path = os.path.join(self.data_dir, bucket_name, identifier)
+        with open(path, "rb") as fh:
+            if not ranges or not os.fstat(fh.fileno()).st_size:
+                # empty files cannot be memory-mapped
+                return
+            local = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for start, length in ranges:
+                begin = time()
+                try:
+                    data = self.get_range(identifier, bucket_name, start, length)
+                except ClientError as err:
+                    if not is_invalid_range(err):
+                        raise
+                    # range starts past the end of a shorter object
+                    data = None
+                latency = time() - begin
+                match = data is not None and buffer(local, start, length) == buffer(data)
+                yield RangeRead(start, length, match, latency)
+        finally:
+            local.close()
+
+    def file_size(self, identifier, bucket_name):
+        return os.path.getsize(os.path.join(self.data_dir, bucket_name, identifier))
 
     def clear_s3_bucket(self, bucket_name):
         s3_bucket = self.get_bucket(bucket_name)
@@ -104,12 +204,29 @@ class S3FSDB(object):
         sys.stdout.write('.')
         sys.stdout.flush()
 
-    def validate(self, bucket_name):
+    def validate(self, bucket_name, range_size=None, order='sequential'):
+        """Check that every object matches the local file
+
+        :param range_size: Read each object in ranges of this many bytes
+        rather than with a single GET. ``order`` is the order in which the
+        ranges are read: 'sequential' or 'random'.
+        """
         bucket_path = os.path.join(self.data_dir, bucket_name)
         total, success, mismatch, s3_not_found, fs_not_found = 0, 0, 0, 0, 0
         for file_name in os.listdir(bucket_path):
             self.dot()
             total += 1
+            if range_size:
+                try:
+                    if self.validate_ranges(file_name, bucket_name, range_size, order):
+                        success += 1
+                    else:
+                        mismatch += 1
+                except IOError:
+                    fs_not_found += 1
+                except NotFound:
+                    s3_not_found += 1
+                continue
             try:
                 file_path = os.path.join(bucket_path, file_name)
                 with open(file_path, "rb") as fh:
@@ -128,11 +245,40 @@ class S3FSDB(object):
 
         return ValidateResult(total, success, mismatch, s3_not_found, fs_not_found)
 
-    def random_read(self, bucket_name):
+    def validate_ranges(self, identifier, bucket_name, range_size, order):
+        size = self.file_size(identifier, bucket_name)
+        if not size:
+            return self.get(identifier, bucket_name) == ""
+        ranges = make_ranges(size, range_size, order=order)
+        reads = self.read_ranges(identifier, bucket_name, ranges)
+        return all(read.match for read in reads)
+
+    def random_read(self, bucket_name, range_size=None, order='random'):
+        """Read a random object
+
+        :param range_size: Read a single verified range of this many bytes
+        from the object instead of the whole object. ``order`` is how the
+        range offset is chosen: 'random' or 'sequential' (continue where
+        the previous ranged read of the object ended).
+        :raises RangeMismatch: if the range does not match the local file.
+        """
         bucket_path = os.path.join(self.data_dir, bucket_name)
         random_file = random.choice(os.listdir(bucket_path))
         self.dot()
-        self.get(random_file, bucket_name)
+        if not range_size:
+            self.get(random_file, bucket_name)
+            return
+
+        size = self.file_size(random_file, bucket_name)
+        if not size:
+            return
+        cursor_key = (bucket_name, random_file)
+        cursor = self.range_cursors.get(cursor_key, 0)
+        ranges = make_ranges(size, range_size, 1, order, cursor)
+        self.range_cursors[cursor_key] = cursor + 1
+        for read in self.read_ranges(random_file, bucket_name, ranges):
+            if not read.match:
+                raise RangeMismatch(bucket_name, random_file, read.start, read.length)
 
     def get_bucket_keys(self, bucket_name):
         bucket = self.get_bucket(bucket_name)
@@ -154,11 +300,47 @@ class S3FSDB(object):
         return self.buckets[bucket_name]
 
 
+class Request(object):
+
+    def __init__(self, db):
+        self.db = db
+        self.size = 0
+
+
+def make_ranges(file_size, range_size, count=None, order='sequential', start=0):
+    """Make ``(start, length)`` byte ranges of a file
+
+    :param count: Number of ranges. If ``None`` the ranges cover the whole
+    file exactly once.
+    :param order: 'sequential' ranges follow each other, wrapping around at
+    the end of the file. 'random' ranges start at random offsets (or are
+    shuffled when covering the whole file).
+    :param start: Index of the first sequential range.
+    """
+    if not file_size:
+        return []
+    if order == 'random' and count is not None:
+        high = max(file_size - range_size, 0)
+        offsets = [random.randint(0, high) for i in range(count)]
+    else:
+        offsets = range(0, file_size, range_size)
+        if order == 'random':
+            random.shuffle(offsets)
+        elif count is not None:
+            offsets = [offsets[(start + i) % len(offsets)] for i in range(count)]
+    return [(offset, min(range_size, file_size - offset)) for offset in offsets]
+
+
 def is_not_found(err, not_found_codes=["NoSuchKey", "NoSuchBucket", "404"]):
     return (err.response["Error"]["Code"] in not_found_codes or
         err.response.get("Errors", {}).get("Error", {}).get("Code") in not_found_codes)
 
 
+def is_invalid_range(err):
+    return (err.response["Error"]["Code"] == "InvalidRange" or
+        err.response.get("Errors", {}).get("Error", {}).get("Code") == "InvalidRange")
+
+
 @contextmanager
 def maybe_not_found(throw=None):
     try:
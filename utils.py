@@ -2,6 +2,7 @@ import json
 import os
 import re
 from time import sleep
+from urlparse import urlparse
 
 import sh
 
@@ -47,6 +48,37 @@ def get_ring_details():
     return ring_num_partitions, ring_ownership
 
 
+def get_node_addresses(config):
+    """Get the S3 address of each running node
+
+    :returns: dict of node index (as used by ``stop_node``) -> (host, port)
+    """
+    host = urlparse(_get_riak_config(config)['url']).hostname
+    docker = sh.Command('docker')
+    names = docker('ps', '--filter', 'ancestor=hectcastro/riak-cs', '--format', '{{.Names}}')
+    addresses = {}
+    for name in str(names).split():
+        port = str(docker('port', name, '8080')).strip().rsplit(':', 1)[-1]
+        addresses[name[len('riak-cs'):]] = (host, int(port))
+    return addresses
+
+
+def get_node_states():
+    """Get the up/down state of every node container
+
+    :returns: dict of node index (as used by ``stop_node``) -> bool (up)
+    """
+    statuses = sh.Command('docker')(
+        'ps', '-a', '--filter', 'ancestor=hectcastro/riak-cs',
+        '--format', '{{.Names}} {{.Status}}', _timeout=5)
+    states = {}
+    for line in str(statuses).splitlines():
+        if line.strip():
+            name, status = line.split(' ', 1)
+            states[name[len('riak-cs'):]] = status.startswith('Up')
+    return states
+
+
 def _get_riak_config(config):
     if not os.path.isfile(config.riak_config_path):
         raise Exception('Config file not found', config.riak_config_path)
@@ -62,3 +94,8 @@ def get_db(config):
         riak_config = _get_riak_config(config)
         _db = S3FSDB(config.data_dir, **riak_config)
     return _db
+
+
+def get_connected_db():
+    """Get the db if ``get_db`` has connected to a cluster, otherwise None"""
+    return _db